@@ -1,59 +1,161 @@
+import codecs
+import contextlib
 import functools
+import io
+import itertools
 import os
 from os import path
+import queue
+import re
+import threading
+import time
 from types import TracebackType
-import polib
 import sqlite3
-from typing import Callable, Optional, Type
+from typing import Callable, Iterator, Optional, Type
+import urllib.parse
 
-CREATE = '''pragma journal_mode=wal;
-create table if not exists po (
+CREATE = '''create table if not exists po (
     updated_at timestamp not null default current_timestamp,
     ref text,
     xcomment text not null default '',
     en text not null,
     primary key (en, xcomment)
-)'''
-HAS_LANG = '''select count(*)
-from sqlite_schema
-where name = ? || '_po'
-'''
-ADD_ENTRY = '''insert into po (updated_at, ref, xcomment, en)
+) without rowid;
+create table if not exists tr (
+    en text not null,
+    xcomment text not null default '',
+    lang text not null,
+    msgstr text,
+    primary key (en, xcomment, lang)
+) without rowid;
+create trigger if not exists tr_add_entry after insert on tr begin
+    insert or ignore into po (xcomment, en) values (new.xcomment, new.en);
+end'''
+BASE_COLUMNS = {'updated_at', 'ref', 'xcomment', 'en'}
+ADD_ENTRY = '''insert or ignore into po (updated_at, ref, xcomment, en)
 values (current_timestamp, ?, ?, ?)'''
+MSGSTR = '''select tr.msgstr
+from po
+left join tr on tr.en = po.en and tr.xcomment = po.xcomment and tr.lang = ?
+where po.en = ? and po.xcomment = ?'''
+UPSERT = '''insert into tr (xcomment, en, lang, msgstr)
+values (?, ?, ?, ?)
+on conflict (en, xcomment, lang) do update set msgstr = excluded.msgstr'''
+PO = '''select po.xcomment, po.ref, po.en, po.updated_at, tr.lang
+from po
+left join tr
+on tr.en = po.en and tr.xcomment = po.xcomment and tr.msgstr is not null
+where po.updated_at >= ?
+order by po.en, po.xcomment'''
+WRITE_BATCH_MAX = 128
+WRITE_BATCH_WAIT = 0.01 # seconds
+CHECKPOINT_INTERVAL = 1.0 # seconds
+WRITE_BUFFER_SIZE = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+ESCAPES = {'\\': '\\\\', '"': '\\"', '\n': '\\n', '\t': '\\t', '\r': '\\r'}
+UNESCAPES = {escaped[1]: char for char, escaped in ESCAPES.items()}
+ESCAPE_RE = re.compile(r'[\\"\n\t\r]')
+UNESCAPE_RE = re.compile(r'\\(.)')
+CHARSET_RE = re.compile(rb'charset=([-\w]+)')
+HEADER_SIZE = 4096
 
-def _add_lang(id: str) -> str:
+def _migrate_lang(id: str) -> list[str]:
     '''
-    Careful–this is directly interpolating the language name into the SQL query.
-    Don't allow untrusted users to run this function. Make sure it's run only by
-    internal tooling.
+    Older databases kept each language's translations in a column of the po
+    table. Move them into the tr table. The column name comes from the database
+    schema itself, not from users.
     '''
-    return f'''alter table po add column "{id}" text;
-    create view "{id}_po" as
-    select
-        iif(xcomment = '', '', '
-#. ' || xcomment) ||
-        iif(ref is null, '', '
-#: ' || ref) ||
-'
-msgid "' ||
-en ||
-'"
-msgstr ""
-' as entry
-    from po
-    where "{id}" is null'''
+    return [
+        f'''insert or ignore into tr (en, xcomment, lang, msgstr)
+select en, xcomment, ?, "{id}" from po where "{id}" is not null''',
+        f'drop view if exists "{id}_po"',
+        f'alter table po drop column "{id}"',
+    ]
+
+def _quote(s: str) -> str:
+    return '"' + ESCAPE_RE.sub(lambda m: ESCAPES[m[0]], s) + '"'
+
+def _unquote(s: str) -> str:
+    '''
+    Unescape a string literal from a PO file, including its quotes. Unknown
+    escapes are kept as they are.
+    '''
+    return UNESCAPE_RE.sub(lambda m: UNESCAPES.get(m[1], m[0]), s[1:-1])
+
+def _entry(xcomment: str, ref: Optional[str], en: str) -> str:
+    return ''.join((
+        ''.join(f'\n#. {line}' for line in xcomment.split('\n')) if xcomment else '',
+        f'\n#: {ref}' if ref else '',
+        f'\nmsgid {_quote(en)}\nmsgstr ""\n'))
+
+def _iter_po(filename: str) -> Iterator[tuple[str, str, str]]:
+    '''
+    Read the entries of the PO file `filename` as tuples of (extracted comment,
+    msgid, msgstr). Only the parts of the format that podb uses are understood,
+    so e.g. plural entries come back with an empty msgstr. The file is decoded
+    with the charset in its header, or UTF-8 if it doesn't have a usable one.
+    '''
+    comments: list[str] = []
+    strings: dict[str, list[str]] = {}
+    keyword = None
+
+    def entry() -> tuple[str, str, str]:
+        return (
+            '\n'.join(comments),
+            ''.join(strings['msgid']),
+            ''.join(strings.get('msgstr', ())))
+
+    with open(filename, 'rb') as po_bytes:
+        match = CHARSET_RE.search(po_bytes.read(HEADER_SIZE))
+        po_bytes.seek(0)
+        encoding = 'utf-8'
+        if match is not None:
+            try:
+                encoding = codecs.lookup(match[1].decode('ascii')).name
+            except LookupError:
+                pass
+
+        with io.TextIOWrapper(po_bytes, encoding=encoding) as po:
+            for raw_line in po:
+                line = raw_line.strip()
+
+                if line.startswith('"'):
+                    if keyword is not None:
+                        strings[keyword].append(_unquote(line))
+                    continue
 
-def _msgstr(lang: str) -> str:
-    return f'select "{lang}" from po where en = ?  and xcomment = ?'
+                # A blank line ends the entry, and so does a comment or a new
+                # msgid after its msgid. Anything collected so far is dropped,
+                # so comments can't leak into the next entry.
+                if not line or (
+                    'msgid' in strings and (
+                        line.startswith('#') or line.startswith('msgid '))):
+                    if 'msgid' in strings: yield entry()
+                    comments.clear()
+                    strings.clear()
 
-def _po(lang: str) -> str:
-    return f'select entry from "{lang}_po"'
+                keyword = None
+                if line.startswith('#.'):
+                    # Only the separator space goes; the comment is part of the
+                    # message's key, so any other whitespace has to be kept.
+                    comment = raw_line.lstrip()[2:].rstrip('\r\n')
+                    comments.append(comment[1:] if comment.startswith(' ') else comment)
+                elif line.startswith('msgid ') or line.startswith('msgstr '):
+                    keyword, _, value = line.partition(' ')
+                    strings[keyword] = [_unquote(value)]
 
-def _upsert(lang: str) -> str:
-    return f'''insert into po (updated_at, xcomment, en, "{lang}")
-values (current_timestamp, ?, ?, ?)
-on conflict (en, xcomment) do update set {lang} = excluded."{lang}"
-'''
+    if 'msgid' in strings: yield entry()
+
+def _language(header: str) -> Optional[str]:
+    '''
+    Find the language in the header of a PO file, i.e. the msgstr of the entry
+    with an empty msgid.
+    '''
+    for line in header.splitlines():
+        key, _, value = line.partition(':')
+        if key.strip() == 'Language': return value.strip() or None
+
+    return None
 
 class Lang:
     def __init__(self, id: str, get_msgstr: Callable[[str, str, str], str]):
@@ -63,6 +165,14 @@ class Lang:
     def __call__(self, msgid: str, xcomment: str='', ref: str=__name__) -> str:
         return self.get_msgstr(msgid, xcomment, ref)
 
+    def clear_cache(self):
+        '''
+        Forget any translations looked up so far, so that the next lookups go
+        back to the database.
+        '''
+        cache_clear = getattr(self.get_msgstr, 'cache_clear', None)
+        if cache_clear is not None: cache_clear()
+
 class Podb:
     def __init__(self, workdir: str='po', filename: str='po.db', missing: str='🇺🇸 '):
         '''
@@ -74,12 +184,57 @@ class Podb:
         self._filename = filename
         self._missing = missing
         self._langs: list[str] = []
+        self._langs_cache: dict[str, Lang] = {}
+        # When the PO files were last written (None if they need to be written
+        # from scratch), for which languages, and which messages added in that
+        # same second were already written
+        self._written_at: Optional[str] = None
+        self._written_langs = 0
+        self._written_keys: set[tuple[str, str]] = set()
 
     def __enter__(self):
         sqlite3.threadsafety = 3
-        self._db = sqlite3.connect(path.join(self._wd, self._filename), check_same_thread=False)
+        db_path = path.join(self._wd, self._filename)
+        self._db = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            cached_statements=256,
+            isolation_level=None)
+        # Only takes effect when the database is first created
+        self._db.execute('pragma page_size=4096')
+        self._db.execute('pragma journal_mode=wal')
+        self._db.execute('pragma synchronous=normal')
+        self._db.execute('pragma temp_store=memory')
+        self._db.execute('pragma cache_size=-8000')
+        self._db.execute(f'pragma mmap_size={MMAP_SIZE}')
+        # Checkpoints are run by the writer thread instead of on commit
+        self._db.execute('pragma wal_autocheckpoint=0')
         self._db.executescript(CREATE)
+        changes = self._db.total_changes
+        self._migrate_langs()
         self._read_pos()
+        if self._db.total_changes != changes:
+            # Imported translations may have to be removed from the PO files
+            self._written_at = None
+            # Move them into the database file, where reads are memory-mapped,
+            # as the writer thread only checkpoints its own writes
+            self._checkpoint()
+
+        # Translations are looked up on a separate read-only connection so they
+        # never wait for writes to the database.
+        self._rdb = sqlite3.connect(
+            f'file:{urllib.parse.quote(db_path)}?mode=ro',
+            uri=True,
+            check_same_thread=False,
+            cached_statements=256,
+            isolation_level=None)
+        self._rdb.execute('pragma cache_size=-8000')
+        self._rdb.execute(f'pragma mmap_size={MMAP_SIZE}')
+
+        self._writes: queue.SimpleQueue[Optional[tuple[str, str, str]]] = queue.SimpleQueue()
+        self._write_error: Optional[sqlite3.Error] = None
+        self._writer = threading.Thread(target=self._write_entries, daemon=True)
+        self._writer.start()
 
         return self
 
@@ -91,55 +246,214 @@ class Podb:
         self._close()
 
     def _close(self):
+        for translator in self._langs_cache.values():
+            translator.clear_cache()
+
+        self._writes.put(None)
+        self._writer.join()
+        self._rdb.close()
         self._write_pos()
         self._db.close()
 
-    @functools.cache
+        error, self._write_error = self._write_error, None
+        if error is not None: raise error
+
     def lang(self, lang: str) -> Lang:
         '''
         Create and register a translator for a language `lang`. Should be
         formatted as e.g. `en` or `en_US` (underscore). Caches the `Lang`
         instances so is safe to call multiple times for the same language.
 
-        WARNING: don't call this with untrusted user input as it can lead to SQL
-        injection. Make sure you call it only with statically-known strings.
+        WARNING: don't call this with untrusted user input as the language name
+        is used as the name of its exported PO file. Make sure you call it only
+        with statically-known strings.
 
         Assumption: the base language for all translations is called 'en'.
         '''
-        if lang == 'en': return Lang('en', lambda msgid, xcomment, ref: msgid)
+        translator = self._langs_cache.get(lang)
+        if translator is not None: return translator
 
-        self._langs.append(lang)
-        self._check_lang(lang)
+        if lang == 'en':
+            return self._langs_cache.setdefault('en', Lang('en', lambda msgid, xcomment, ref: msgid))
 
         # E.g. en_GB backup is en
-        backup_lang = lang.split('-')[0] if '-' in lang else None
-        msgstr = _msgstr(lang)
+        head, sep, _ = lang.partition('_')
+        backup_lang = head if sep else None
+        # Cursors can't be shared between threads, so each thread that looks up
+        # translations gets its own, for the connection that's currently open.
+        cursors = threading.local()
+
+        # Missing and backup translations are cached too, so a missing message
+        # is added to the database only once. Values that are fixed for the life
+        # of the translator are bound as default arguments so they're read as
+        # local variables. The connection and write queue are looked up on each
+        # call because they change when the database is closed and reopened.
+        @functools.lru_cache(maxsize=4096)
+        def get_msgstr(
+            msgid: str,
+            xcomment: str,
+            ref: str,
+            _lang: str=lang,
+            _backup_lang: Optional[str]=backup_lang,
+            _cursors: threading.local=cursors,
+            _missing: str=self._missing,
+            _get_lang: Callable[[str], Lang]=self.lang) -> str:
+            rdb = self._rdb
+            cursor = getattr(_cursors, 'cursor', None)
+            if cursor is None or cursor.connection is not rdb:
+                cursor = _cursors.cursor = rdb.cursor()
 
-        def get_msgstr(msgid: str, xcomment: str, ref: str) -> str:
-            row = self._db.execute(msgstr, (msgid, xcomment)).fetchone()
+            row = cursor.execute(MSGSTR, (_lang, msgid, xcomment)).fetchone()
 
             if row is None:
-                self._db.execute(ADD_ENTRY, (ref, xcomment, msgid))
-                self._db.commit()
+                self._writes.put((ref, xcomment, msgid))
 
-                return self._missing + msgid if backup_lang is None else self.lang(backup_lang)(msgid, xcomment, ref)
+                return _missing + msgid if _backup_lang is None else _get_lang(_backup_lang)(msgid, xcomment, ref)
 
             if row[0] is None:
-                return self._missing + msgid if backup_lang is None else self.lang(backup_lang)(msgid, xcomment, ref)
+                return _missing + msgid if _backup_lang is None else _get_lang(_backup_lang)(msgid, xcomment, ref)
 
             return row[0]
 
-        return Lang(lang, get_msgstr)
+        # Threads may race to create the same translator. Only the one that gets
+        # into the cache first registers the language, so each PO file is
+        # written once.
+        translator = self._langs_cache.setdefault(lang, Lang(lang, get_msgstr))
+        if translator.get_msgstr is get_msgstr: self._langs.append(lang)
+
+        return translator
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''
+        The connection is in autocommit mode, so batches of writes need to be
+        wrapped in an explicit transaction to be committed together.
+        '''
+        self._db.execute('begin immediate')
+        try:
+            yield
+            self._db.execute('commit')
+        except BaseException:
+            if self._db.in_transaction: self._db.execute('rollback')
+            raise
+
+    def _write_entries(self):
+        '''
+        Runs on the writer thread. Adds the missing messages queued by lookups
+        to the database in batches, and checkpoints the WAL when the queue has
+        been idle for a while, or at least every `CHECKPOINT_INTERVAL` seconds
+        while messages keep coming in. Stops when it gets `None`.
+
+        If a batch can't be written, e.g. because the database is locked, it's
+        kept and retried with the next one. The error is saved so that `_close`
+        can raise it if the messages still haven't been written by then.
+        '''
+        batch: list[tuple[str, str, str]] = []
+        dirty = False
+        checkpointed_at = time.monotonic()
+
+        while True:
+            try:
+                entry = self._writes.get(timeout=CHECKPOINT_INTERVAL)
+            except queue.Empty:
+                if batch: dirty = self._write_batch(batch) or dirty
+                if dirty and not batch and self._checkpoint():
+                    dirty = False
+                    checkpointed_at = time.monotonic()
+                continue
+
+            deadline = time.monotonic() + WRITE_BATCH_WAIT
+            while entry is not None:
+                batch.append(entry)
+                if len(batch) >= WRITE_BATCH_MAX: break
+
+                try:
+                    entry = self._writes.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            if batch: dirty = self._write_batch(batch) or dirty
+
+            if entry is None: return
+
+            # With steady traffic the queue is never idle, so also checkpoint
+            # on a timer
+            if dirty and time.monotonic() - checkpointed_at >= CHECKPOINT_INTERVAL:
+                if self._checkpoint(): dirty = False
+                checkpointed_at = time.monotonic()
+
+    def _checkpoint(self) -> bool:
+        '''
+        Copy committed pages from the WAL into the database file without
+        waiting for readers. Returns whether it ran.
+        '''
+        try:
+            self._db.execute('pragma wal_checkpoint(passive)')
+        except sqlite3.Error:
+            return False
+
+        return True
 
-    def _check_lang(self, lang: str):
-        if self._db.execute(HAS_LANG, (lang,)).fetchone() == (0,):
-            self._db.executescript(_add_lang(lang))
-            self._db.commit()
+    def _write_batch(self, batch: list[tuple[str, str, str]]) -> bool:
+        '''
+        Try to add a batch of missing messages to the database. On success the
+        batch is emptied and any saved error is forgotten.
+        '''
+        try:
+            with self._transaction():
+                self._db.executemany(ADD_ENTRY, batch)
+        except sqlite3.Error as e:
+            self._write_error = e
+            return False
+
+        batch.clear()
+        self._write_error = None
+        return True
+
+    def _migrate_langs(self):
+        langs = {
+            row[1] for row in self._db.execute('pragma table_info(po)')
+        } - BASE_COLUMNS
+        if not langs: return
+
+        with self._transaction():
+            for lang in langs:
+                insert, *drops = _migrate_lang(lang)
+                self._db.execute(insert, (lang,))
+                for drop in drops: self._db.execute(drop)
 
     def _write_pos(self):
-        for lang in self._langs:
-            with open(path.join(self._wd, lang + '.po'), 'w') as lang_po:
-                lang_po.write(f'''msgid ""
+        '''
+        Export the messages that are missing translations to the PO files. The
+        first time, each file is written from scratch. After that, only the
+        messages added since then are appended. The files are written from
+        scratch again if new languages have been registered, any of the files
+        is gone, or translations were imported since the last time.
+        '''
+        if not self._langs: return
+
+        lang_po_paths = [path.join(self._wd, lang + '.po') for lang in self._langs]
+        append = (
+            self._written_at is not None
+            and self._written_langs == len(self._langs)
+            and all(path.isfile(lang_po_path) for lang_po_path in lang_po_paths))
+        written_since = self._written_at if append else ''
+        if not append: self._written_keys.clear()
+
+        (written_at,) = self._db.execute('select current_timestamp').fetchone()
+        written_keys = set()
+        # If writing fails partway, start from scratch next time
+        self._written_at = None
+
+        with contextlib.ExitStack() as stack:
+            lang_pos = []
+            for lang, lang_po_path in zip(self._langs, lang_po_paths):
+                lang_po = stack.enter_context(open(
+                    lang_po_path,
+                    'a' if append else 'w',
+                    buffering=WRITE_BUFFER_SIZE))
+                if not append:
+                    lang_po.write(f'''msgid ""
 msgstr ""
 "MIME-Version: 1.0\\n"
 "Content-Type: text/plain; charset=UTF-8\\n"
@@ -148,25 +462,47 @@ msgstr ""
 "Project-Id-Version: {self._filename}\\n"
 "Language: {lang}\\n"
 ''')
+                lang_pos.append(lang_po)
+
+            # One scan of the tables for all languages. Each message comes with
+            # the languages it's translated into, and goes to the PO files of
+            # the other languages.
+            rows = self._db.execute(PO, (written_since,))
+            for (xcomment, ref, en, updated_at), group in itertools.groupby(rows, lambda row: row[:4]):
+                if updated_at >= written_at: written_keys.add((en, xcomment))
+                if (en, xcomment) in self._written_keys: continue
+
+                translated = {row[4] for row in group}
+                entry = None
+                for lang, lang_po in zip(self._langs, lang_pos):
+                    if lang not in translated:
+                        if entry is None: entry = _entry(xcomment, ref, en)
+                        lang_po.write(entry)
 
-                for (entry,) in self._db.execute(_po(lang)).fetchall():
-                    lang_po.write(entry)
+        self._written_at = written_at
+        self._written_langs = len(self._langs)
+        self._written_keys = written_keys
 
     def _read_pos(self):
-        for file in os.listdir(self._wd):
-            if file.endswith('.po'):
-                po = polib.pofile(path.join(self._wd, file))
-                upsert = _upsert(
-                    po.metadata['Language']
-                    if 'Language' in po.metadata
-                    else file[:-3])
-
-                for entry in po:
-                    msgstr = entry.msgstr
-                    if msgstr == '': continue
-
-                    self._db.execute(
-                        upsert,
-                        (entry.comment, entry.msgid, msgstr))
-
-        self._db.commit()
+        with self._transaction():
+            with os.scandir(self._wd) as files:
+                for file in files:
+                    if not file.name.endswith('.po') or not file.is_file(follow_symlinks=False):
+                        continue
+
+                    entries = _iter_po(file.path)
+                    first = next(entries, None)
+                    if first is None: continue
+
+                    lang = None
+                    if first[1] == '':
+                        lang = _language(first[2])
+                    else:
+                        entries = itertools.chain((first,), entries)
+                    if lang is None: lang = file.name[:-3]
+
+                    self._db.executemany(
+                        UPSERT,
+                        ((xcomment, en, lang, msgstr)
+                         for (xcomment, en, msgstr) in entries
+                         if msgstr))
@@ -1,4 +1,6 @@
-from podb import Podb
+import os
+import tempfile
+from podb import Podb, _entry, _iter_po
 
 def main(po_db: Podb):
     fr = po_db.lang('fr')
@@ -9,6 +11,93 @@ def main(po_db: Podb):
     print('meter in British English:', en_GB('meter'))
     print('meter in French:', fr('meter'))
 
+def round_trip():
+    '''
+    Check that the PO entries podb writes are read back unchanged.
+    '''
+    entries = [
+        ('', 'say "hi"', ''),
+        ('', 'back\\slash', ''),
+        ('one line', 'new\nline\tand tab', ''),
+        ('first line\nsecond line', 'multi-line comment', ''),
+        ('  leading and trailing spaces ', 'spaced comment', ''),
+    ]
+    plural = '''
+#. plural comment
+msgid "apple"
+msgid_plural "apples"
+msgstr[0] "pomme"
+msgstr[1] "pommes"
+'''
+
+    with tempfile.TemporaryDirectory() as wd:
+        filename = os.path.join(wd, 'fr.po')
+        with open(filename, 'w', encoding='utf-8') as po:
+            po.write('msgid ""\nmsgstr "Language: fr\\n"\n')
+            for (xcomment, en, _) in entries[:1]:
+                po.write(_entry(xcomment, None, en))
+            po.write(plural)
+            for (xcomment, en, _) in entries[1:]:
+                po.write(_entry(xcomment, None, en))
+
+        read = list(_iter_po(filename))
+
+    assert read == [
+        ('', '', 'Language: fr\n'),
+        entries[0],
+        ('plural comment', 'apple', ''),
+        *entries[1:],
+    ], read
+    print('PO round trip: ok')
+
+def reopen():
+    '''
+    Check that reopening appends only the new messages to the PO files, and
+    that importing a translation makes podb write them from scratch again.
+    '''
+    with tempfile.TemporaryDirectory() as wd:
+        fr_po = os.path.join(wd, 'fr.po')
+
+        def msgids() -> list[str]:
+            with open(fr_po, encoding='utf-8') as po:
+                return [line for line in po if line.startswith('msgid ')]
+
+        def has_marker() -> bool:
+            with open(fr_po, encoding='utf-8') as po:
+                return '# marker\n' in po.read()
+
+        po_db = Podb(workdir=wd)
+        with po_db:
+            fr = po_db.lang('fr')
+            fr('a')
+
+        # Only survives if the file is appended to instead of rewritten
+        with open(fr_po, 'a', encoding='utf-8') as po:
+            po.write('# marker\n')
+
+        with po_db:
+            fr('b')
+
+        assert has_marker()
+        assert msgids() == ['msgid ""\n', 'msgid "a"\n', 'msgid "b"\n'], msgids()
+
+        with open(fr_po, encoding='utf-8') as po:
+            translated = po.read().replace('msgid "a"\nmsgstr ""', 'msgid "a"\nmsgstr "A"')
+        with open(fr_po, 'w', encoding='utf-8') as po:
+            po.write(translated)
+
+        with po_db:
+            assert fr('a') == 'A'
+            fr('c')
+
+        assert not has_marker()
+        assert msgids() == ['msgid ""\n', 'msgid "b"\n', 'msgid "c"\n'], msgids()
+
+    print('PO reopen: ok')
+
 if __name__ == '__main__':
+    round_trip()
+    reopen()
+
     with Podb() as po_db:
         main(po_db)